@@ -9,14 +9,20 @@ WishCo Branch Portal — เบิกอุปกรณ์ (v11)
 """
 
 from __future__ import annotations
-import os, json, time
+import os, json, time, hmac, hashlib, base64
+from collections.abc import Mapping
+from functools import lru_cache
 from typing import Any, Dict, List
 
 import streamlit as st
+import numpy as np
 import pandas as pd
 
 try:
     import gspread  # type: ignore
+    from gspread.utils import fill_gaps, rowcol_to_a1  # type: ignore
+    from requests.adapters import HTTPAdapter  # type: ignore
+    from urllib3.util.retry import Retry  # type: ignore
 except Exception:
     gspread = None
 
@@ -25,12 +31,23 @@ try:
 except Exception:
     bcrypt = None
 
+try:
+    import orjson  # type: ignore
+except Exception:
+    orjson = None
+
 
 # ----------------------------- Helpers & Config ------------------------------
 REQ_HEADER = ["RequestTime","RequestID","Username","BranchCode",
               "ItemCode","ItemName","Qty","Status","Note"]
 TX_HEADER  = ["TxTime","TxID","Username","BranchCode",
               "ItemCode","ItemName","Qty","Type","Note"]
+USERS_HEADER = ["Username","DisplayName","Role","PasswordHash","Active","BranchCode"]
+ITEMS_HEADER = ["ItemCode","ItemName","Stock","Unit","Category","Active"]
+SHEET_HEADERS = {"Users": USERS_HEADER, "Items": ITEMS_HEADER,
+                 "Requests": REQ_HEADER, "Transactions": TX_HEADER}
+# every sheet comes back from one values.batchGet: login warms the issue page
+_ALL_SHEETS = tuple(SHEET_HEADERS)
 
 CANON = {
     "username":    ["username","user","บัญชีผู้ใช้","ชื่อผู้ใช้","ชื่อเข้าใช้","Username","User"],
@@ -51,25 +68,54 @@ CANON = {
     "status":      ["status","สถานะ","Status"],
     "qty":         ["qty","จำนวน","Qty"],
     "note":        ["note","หมายเหตุ","Note"],
-}
 
-def _normalize(df: pd.DataFrame) -> pd.DataFrame:
-    """Rename columns to canonical keys when possible."""
-    lowers = {str(c).strip().lower(): c for c in df.columns}
+    "txtime":      ["txtime","TxTime"],
+    "txid":        ["txid","TxID"],
+    "type":        ["type","ประเภท","Type"],
+}
+# lowercased alias lookup order per canonical key (built once, not per sheet read)
+_CANON_LC = {canon: tuple(dict.fromkeys(a.lower() for a in alts + [canon]))
+             for canon, alts in CANON.items()}
+
+@lru_cache(maxsize=64)
+def _canon_mapping(columns: tuple) -> Dict[Any, str]:
+    """Column -> canonical key for one header layout (resolved once, reused every rerun)."""
+    lowers = {str(c).strip().lower(): c for c in columns}
     mapping = {}
-    for canon, alts in CANON.items():
-        for name in alts + [canon]:
-            key = name.lower()
+    for canon, keys in _CANON_LC.items():
+        for key in keys:
             if key in lowers:
                 mapping[lowers[key]] = canon
                 break
-    return df.rename(columns=mapping).copy()
+    return mapping
+
+@lru_cache(maxsize=256)
+def _pick_col(columns: tuple, cands: tuple):
+    """First candidate present in ``columns`` (exact, then case-insensitive)."""
+    for c in cands:
+        if c in columns: return c
+    lowers = {str(c).lower(): c for c in columns}
+    for c in cands:
+        if c.lower() in lowers: return lowers[c.lower()]
+    return None
+
+def _normalize(df: pd.DataFrame) -> pd.DataFrame:
+    """Rename columns to canonical keys when possible."""
+    return df.rename(columns=_canon_mapping(tuple(df.columns)))
+
+_TS_FMT = "%Y-%m-%d %H:%M:%S"
+
+def _now_str(t: time.struct_time = None) -> str:
+    return time.strftime(_TS_FMT, t or time.localtime())
 
 def _ensure_session():
     for k, v in [("auth", False), ("user", {}),
                  ("sel_map", {}), ("qty_map", {}), ("last_order_id", ""), ("recent_request_snap", None)]:
         if k not in st.session_state: st.session_state[k] = v
 
+# partial reruns where available (st.fragment, then experimental_fragment), else a no-op wrapper
+_fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None) or (lambda f: f)
+
 def _safe_rerun():
     try: st.rerun()
     except Exception:
@@ -77,6 +123,16 @@ def _safe_rerun():
         except Exception: pass
 
 
+def _plain(v):
+    return {k: _plain(x) for k, x in v.items()} if isinstance(v, Mapping) else v
+
+@lru_cache(maxsize=1)
+def _secrets() -> Dict[str, Any]:
+    """st.secrets as a plain (nested) dict, read once instead of on every rerun."""
+    try: return _plain(st.secrets)
+    except Exception: return {}
+
+
 def _get_sa_dict_from_secrets():
     """Return a dict of Google Service Account credentials from secrets/env.
 
@@ -89,7 +145,7 @@ def _get_sa_dict_from_secrets():
     """
     def _try_parse_json_string(s):
         try:
-            return json.loads(s)
+            return orjson.loads(s) if orjson else json.loads(s)
         except Exception:
             # base64?
             try:
@@ -105,10 +161,7 @@ def _get_sa_dict_from_secrets():
                     pass
         return None
 
-    try:
-        s = st.secrets
-    except Exception:
-        s = {}
+    s = _secrets()
 
     # 1) Streamlit secrets common keys
     if isinstance(s, dict):
@@ -144,10 +197,10 @@ def _get_sa_dict_from_secrets():
     return None
 
 
+@lru_cache(maxsize=1)
 def _sheet_loc():
     out = {}
-    try: s = st.secrets
-    except Exception: s = {}
+    s = _secrets()
     for k in ("SHEET_ID","sheet_id","SPREADSHEET_ID","SHEET_URL","sheet_url","SPREADSHEET_URL"):
         v = None
         if isinstance(s, dict) and k in s: v = s[k]
@@ -157,90 +210,319 @@ def _sheet_loc():
             else: out["sheet_id"] = str(v)
     return out
 
-def _open_spreadsheet():
+@st.cache_resource(show_spinner=False)
+def _client():
+    """Authorized gspread client, shared across reruns and sessions."""
     if gspread is None: raise RuntimeError("gspread not available")
     sa = _get_sa_dict_from_secrets()
     if not sa: raise RuntimeError("Service Account not found in secrets")
     gc = gspread.service_account_from_dict(sa)
+    # pooled keep-alive connections (sessions share this client) and backoff on 429/5xx;
+    # urllib3 only retries idempotent methods, so appendCells POSTs are never replayed
+    sess = getattr(getattr(gc, "http_client", gc), "session", None)
+    if sess is not None:
+        sess.mount("https://", HTTPAdapter(pool_maxsize=8, max_retries=Retry(
+            total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+            respect_retry_after_header=True, raise_on_status=False)))
+    return gc
+
+@st.cache_resource(show_spinner=False)
+def _open_spreadsheet():
+    gc = _client()
     loc = _sheet_loc()
     if "sheet_id" in loc: return gc.open_by_key(loc["sheet_id"])
     if "sheet_url" in loc: return gc.open_by_url(loc["sheet_url"])
     raise RuntimeError("Missing SHEET_ID or SHEET_URL in secrets/env")
 
+def _ensure_sheets(ss, headers: Mapping[str, List[str]]) -> Dict[str, Any]:
+    # header rows already seen this session (title -> header); skips the row-1 read
+    known = st.session_state.setdefault("_headers", {})
+    # verified worksheet handles; ss.worksheet() is a metadata fetch per call
+    handles = st.session_state.setdefault("_worksheets", {})
+    if not handles:
+        # first use this session: all handles from one metadata fetch, all header rows from one
+        # uncached batchGet (never through _values: we may be inside that read's recovery)
+        found = {w.title: w for w in ss.worksheets()}
+        have = [t for t in SHEET_HEADERS if t in found]
+        if have:
+            for t, rows in zip(have, _live_values(ss, *[f"'{t}'!1:1" for t in have])):
+                known[t] = rows[0] if rows else []
+        # publish handles only once their headers are known, else a failed read above
+        # would leave existing sheets looking header-less and get row 1 overwritten
+        handles.update(found)
+    out, writes = {}, {}
+    for title, header in headers.items():
+        ws = handles.get(title)
+        if ws is None:
+            ws = handles[title] = ss.add_worksheet(title=title, rows=1000, cols=max(10, len(header)))
+        if not known.get(title):
+            writes[title] = list(header)
+        out[title] = ws
+    if writes:
+        # every missing header row in one values.batchUpdate
+        ss.values_batch_update({"valueInputOption": "RAW", "data": [
+            {"range": f"'{t}'!A1:{rowcol_to_a1(1, len(h))}", "values": [h]} for t, h in writes.items()]})
+        known.update(writes)
+    return out
+
 def _ensure_sheet(ss, title: str, header: List[str]) -> Any:
+    return _ensure_sheets(ss, {title: header})[title]
+
+def _col_index(ss, title: str) -> Dict[str, int]:
+    """Canonical key -> 0-based column (any CANON alias, as _normalize reads it), from the header verified this session."""
+    _ensure_sheet(ss, title, SHEET_HEADERS[title])
+    header = tuple(st.session_state["_headers"][title])
+    canon = _canon_mapping(header)
+    out: Dict[str, int] = {}
+    for i, h in enumerate(header):
+        if h in canon: out.setdefault(canon[h], i)
+    return out
+
+@st.cache_data(ttl=30, show_spinner=False)
+def _sheet_values(_ss, sheet_id: str, keys: tuple) -> Dict[str, List[List[str]]]:
+    """Values of several sheets from one values.batchGet; ``keys`` is ((title, version), ...)."""
+    titles = [t for t, _ in keys]
+    ranges = [f"'{t}'" for t in titles]
     try:
-        ws = ss.worksheet(title)
-        got = ws.get_all_values()
-        if not got:
-            ws.update(f"A1:{chr(ord('A')+len(header)-1)}1", [header])
-        return ws
+        resp = _ss.values_batch_get(ranges)
     except Exception:
-        ws = ss.add_worksheet(title=title, rows=1000, cols=max(10, len(header)))
-        ws.update(f"A1:{chr(ord('A')+len(header)-1)}1", [header])
-        return ws
+        # a missing sheet fails the whole batch: create it, then retry once
+        _ensure_sheets(_ss, {t: SHEET_HEADERS[t] for t in titles})
+        resp = _ss.values_batch_get(ranges)
+    got = resp.get("valueRanges", [])
+    return {t: fill_gaps(r.get("values", [])) for t, r in zip(titles, got)}
+
+@st.cache_resource(show_spinner=False)
+def _versions() -> Dict[str, int]:
+    """Per-sheet version stamps, one dict for the whole process: the cache entries they key are shared."""
+    return {}
+
+def _ver(title: str) -> int:
+    return _versions().get(title, 0)
+
+def _read_keys() -> tuple:
+    return tuple((t, _ver(t)) for t in _ALL_SHEETS)
+
+def _values(ss, title: str) -> List[List[str]]:
+    """Read a sheet through the cache."""
+    return _sheet_values(ss, ss.id, _read_keys())[title]
+
+def _live_values(ss, *ranges: str) -> List[List[List[str]]]:
+    """Uncached values for several A1 ranges from one values.batchGet (validation/writes)."""
+    resp = ss.values_batch_get(list(ranges))
+    return [fill_gaps(r.get("values", [])) for r in resp.get("valueRanges", [])]
+
+def _col_range(ss, title: str, key: str, default: int) -> str:
+    """A1 range of one whole column, located by canonical key (any CANON alias), else at ``default``."""
+    col = rowcol_to_a1(1, _col_index(ss, title).get(key, default) + 1).rstrip("0123456789")
+    return f"'{title}'!{col}:{col}"
+
+# low-cardinality columns kept as category: equality/isin compare integer codes
+_CATEGORICAL = ("branchcode", "status", "type")
+
+@st.cache_data(ttl=30, show_spinner=False)
+def _typed_df(_ss, sheet_id: str, title: str, ver: int) -> pd.DataFrame:
+    vals = _values(_ss, title)
+    df = _normalize(_values_df(vals)) if vals else pd.DataFrame()
+    if "qty" in df.columns:
+        df["qty_num"] = pd.to_numeric(df["qty"], errors="coerce").fillna(0).astype(float)
+        if "itemname" in df.columns:
+            # "name (qty)" label for the recent-orders list, built once per cache epoch
+            df["_pair"] = df["itemname"].astype(str).str.cat(df["qty_num"].astype(int).astype(str), sep=" (") + ")"
+    if "username" in df.columns:
+        df["_user"] = df["username"].astype(str).str.strip().str.lower().astype("category")
+    for c in _CATEGORICAL:
+        if c in df.columns: df[c] = df[c].astype("category")
+    return df
+
+def _sheet_df(ss, title: str) -> pd.DataFrame:
+    """Normalized sheet frame with ``qty_num``; re-parsed only when ``title`` changes."""
+    return _typed_df(ss, ss.id, title, _ver(title))
+
+def _invalidate(*titles: str):
+    """Re-stamp the sheets we just wrote so only their cache entries go stale, for every session."""
+    vers = _versions()
+    stamp = time.time_ns()
+    for t in titles:
+        # a clock stamp, not a plain counter: concurrent writers never land on the same version
+        vers[t] = max(stamp, vers.get(t, 0) + 1)
+
+def _values_df(vals: List[List[str]]) -> pd.DataFrame:
+    """DataFrame from sheet values (header first) via one object block, no per-row inference."""
+    header = vals[0]
+    arr = np.array(vals[1:], dtype=object).reshape(-1, len(header))
+    return pd.DataFrame(arr, columns=header, copy=False)
 
 def _read_users_df(ss) -> pd.DataFrame:
-    ws = _ensure_sheet(ss, "Users", ["Username","DisplayName","Role","PasswordHash","Active","BranchCode"])
-    vals = ws.get_all_values()
-    vals = vals if vals else [["Username","DisplayName","Role","PasswordHash","Active","BranchCode"]]
-    df = pd.DataFrame(vals[1:], columns=vals[0])
+    vals = _values(ss, "Users")
+    vals = vals if vals else [USERS_HEADER]
+    df = _values_df(vals)
     return _normalize(df)
 
-def _read_items_df(ss) -> pd.DataFrame:
-    ws = _ensure_sheet(ss, "Items", ["ItemCode","ItemName","Stock","Unit","Category","Active"])
-    vals = ws.get_all_values()
-    vals = vals if vals else [["ItemCode","ItemName","Stock","Unit","Category","Active"]]
-    df = pd.DataFrame(vals[1:], columns=vals[0])
+@st.cache_data(ttl=30, show_spinner=False)
+def _users_index(_ss, sheet_id: str, ver: int) -> Dict[str, Dict[str, Any]]:
+    """Users rows keyed by stripped, lowercased username (first row wins).
+
+    Plain-text passwords are kept only as SHA-256 digests in the cached index.
+    """
+    df = _read_users_df(_ss)
+    if "password" in df.columns:
+        df["password"] = [_pw_digest(p) if p else None for p in df["password"].astype(str).str.strip()]
+    key = df["username"].astype(str).str.strip().str.lower()
+    return df.assign(_key=key).drop_duplicates("_key").set_index("_key").to_dict(orient="index")
+
+def _read_items_df(ss, vals: List[List[str]] = None) -> pd.DataFrame:
+    vals = _values(ss, "Items") if vals is None else vals
+    vals = vals if vals else [ITEMS_HEADER]
+    df = _values_df(vals)
     df = _normalize(df)
     if "stock" in df.columns:
-        def to_num(x):
-            try:
-                s = str(x).replace(",","").strip()
-                return float(s) if s else 0.0
-            except Exception: return 0.0
-        df["stock"] = df["stock"].map(to_num)
+        s = df["stock"].astype(str).str.replace(",", "", regex=False).str.strip()
+        df["stock"] = pd.to_numeric(s, errors="coerce").fillna(0.0).astype(float)
     return df
 
+@st.cache_data(ttl=30, show_spinner=False)
+def _active_items(_ss, sheet_id: str, ver: int) -> pd.DataFrame:
+    """Active Items, parsed/normalized once per cache epoch instead of every rerun."""
+    items = _read_items_df(_ss)
+    if "active" in items.columns:
+        items = items[_active_mask(items["active"])]
+    items = items.assign(**{c: items[c].astype(str) for c in ("itemcode", "itemname", "unit") if c in items.columns})
+    # one lowercased name+code key per row for the search box
+    return items.assign(_search=(items["itemname"] + "\x00" + items["itemcode"]).str.lower())
+
 def _requests_ws(ss):    return _ensure_sheet(ss, "Requests", REQ_HEADER)
 def _transactions_ws(ss):return _ensure_sheet(ss, "Transactions", TX_HEADER)
 
-def _append_rows(ws, rows: List[List[Any]]):
-    ws.append_rows(rows, value_input_option="USER_ENTERED")
+def _cell(v) -> Dict[str, Any]:
+    if isinstance(v, (int, float)) and not isinstance(v, bool):
+        return {"userEnteredValue": {"numberValue": v}}
+    return {"userEnteredValue": {"stringValue": "" if v is None else str(v)}}
+
+def _in_sheet_order(ss, title: str, rows: List[list]) -> List[list]:
+    """Reorder rows built in SHEET_HEADERS order to match the sheet's own header.
+
+    Uses the header verified this session; no row-1 read on the submit path.
+    """
+    std = SHEET_HEADERS[title]
+    _ensure_sheet(ss, title, std)
+    header = st.session_state["_headers"][title]
+    want = _canon_mapping(tuple(std))
+    pos = {want[h]: i for i, h in enumerate(std)}
+    have = _canon_mapping(tuple(header))
+    # cells no alias identifies keep their standard position's value (as a positional write would)
+    idx = [pos.get(have[h]) if h in have else (j if j < len(std) else None)
+           for j, h in enumerate(header)]
+    if idx == list(range(len(std))): return rows
+    return [[r[i] if i is not None else "" for i in idx] for r in rows]
+
+def _append_rows_batch(ss, batches: List[tuple]):
+    """Append rows to several worksheets with one spreadsheets.batchUpdate call.
+
+    ``batches`` is a list of ``(worksheet, rows)``; the whole call is atomic.
+    """
+    reqs = [{"appendCells": {"sheetId": ws.id,
+                             "rows": [{"values": [_cell(v) for v in r]} for r in rows],
+                             "fields": "userEnteredValue"}}
+            for ws, rows in batches if rows]
+    if reqs: ss.batch_update({"requests": reqs})
+
+def _row_ranges(row: int, cells: Dict[int, Any]) -> List[Dict[str, Any]]:
+    """batch_update entries for one row: one range per run of adjacent columns."""
+    out, run = [], []
+    for c in sorted(cells) + [None]:
+        if run and c != run[-1] + 1:
+            rng = rowcol_to_a1(row, run[0]) + (f":{rowcol_to_a1(row, run[-1])}" if len(run) > 1 else "")
+            out.append({"range": rng, "values": [[cells[x] for x in run]]})
+            run = []
+        if c is not None: run.append(c)
+    return out
+
+_INACTIVE = ("n","no","0","false","inactive","disabled")
 
 def _is_active(val)->bool:
     s = str(val).strip().lower()
-    return s not in ("n","no","0","false","inactive","disabled")
+    return s not in _INACTIVE
+
+def _active_mask(col: pd.Series) -> pd.Series:
+    """Vectorized _is_active over a whole column."""
+    return ~col.astype(str).str.strip().str.lower().isin(_INACTIVE)
+
+@st.cache_resource(show_spinner=False)
+def _bcrypt_memo() -> Dict[str, Any]:
+    """Random per-process HMAC key + bcrypt results keyed on HMAC(password), never the password."""
+    return {"key": os.urandom(32), "results": {}}
+
+def _bcrypt_check(raw: str, ph: str) -> bool:
+    # bcrypt is deliberately slow and login reruns re-verify the same pair. Results are shared
+    # by every session until the process restarts; the keyed hash keeps plaintext out of memory.
+    memo = _bcrypt_memo()
+    k = (hmac.new(memo["key"], raw.encode("utf-8"), hashlib.sha256).digest(), ph)
+    results = memo["results"]
+    if k not in results:
+        if len(results) >= 256: results.clear()
+        results[k] = bcrypt.checkpw(raw.encode("utf-8"), ph.encode("utf-8"))
+    return results[k]
+
+def _pw_digest(v: str) -> bytes:
+    return hashlib.sha256(v.encode("utf-8")).digest()
+
+_NO_USER = {"password": b"\0" * 32}  # dummy digest when the sheet has no bcrypt hashes
+
+@st.cache_resource(show_spinner=False)
+def _dummy_bcrypt(cost: int) -> str:
+    """Throwaway hash of a random secret at the sheet's bcrypt cost."""
+    return bcrypt.hashpw(os.urandom(16), bcrypt.gensalt(cost)).decode("ascii")
+
+def _stand_in_user(users: Mapping[str, dict]) -> dict:
+    """Row to verify against when the username is unknown: same work as a real account."""
+    if bcrypt:
+        for r in users.values():
+            ph = str(r.get("passwordhash") or "").strip()
+            if ph.startswith("$2"):
+                cost = ph[4:6]
+                return {"passwordhash": _dummy_bcrypt(int(cost) if cost.isdigit() else 12)}
+    return _NO_USER
 
 def _verify_pw(row, raw)->bool:
     ph = str(row.get("passwordhash") or "").strip()
-    pw = str(row.get("password") or "").strip()
-    if ph and bcrypt:
+    pw = row.get("password")  # digest from _users_index
+    if ph and bcrypt and ph.startswith("$2"):
         try:
-            return bcrypt.checkpw((raw or "").encode("utf-8"), ph.encode("utf-8"))
+            return _bcrypt_check(raw or "", ph)
         except Exception:
             pass
     if pw:
-        return (raw or "") == pw
+        return hmac.compare_digest(pw, _pw_digest(raw or ""))
     return False
 
+_STATUS_BY_RANK = ("Pending", "Approved", "Canceled")
+
+def _status_rank(v) -> int:
+    s = str(v).strip().lower()
+    if s in ("canceled", "cancelled"): return 2
+    if s in ("approved", "อนุมัติ"): return 1
+    return 0
+
+def _status_ranks(col: pd.Series) -> pd.Series:
+    """Per-row status rank; on a category column only the categories are mapped."""
+    return col.map(_status_rank).astype(int)
+
 def _branch_code(row)->str:
     bc = str(row.get("branchcode") or "").strip()
     return bc or "SWC000"
 
-def _generate_order_id(ss, username: str) -> str:
+def _generate_order_id(username: str, ids: List[str], t: time.struct_time = None) -> str:
+    """Next USER+YYMMDD-XX id given the live RequestID column values."""
     uname = (username or "").strip().upper()
-    ymd = time.strftime("%y%m%d")
+    ymd = time.strftime("%y%m%d", t or time.localtime())
     prefix = f"{uname}{ymd}-"
-    ws = _requests_ws(ss)
-    vals = ws.get_all_values()
     mx = 0
-    if vals and len(vals) > 1:
-        for r in vals[1:]:
-            rid = r[1] if len(r)>1 else ""
-            if isinstance(rid, str) and rid.startswith(prefix) and len(rid) >= len(prefix)+2:
-                suf = rid[len(prefix):len(prefix)+2]
-                if suf.isdigit():
-                    mx = max(mx, int(suf))
+    for rid in ids:
+        if rid.startswith(prefix):
+            suf = rid[len(prefix):len(prefix)+2]
+            if len(suf) == 2 and suf.isdigit():
+                mx = max(mx, int(suf))
     return f"{prefix}{min(mx+1, 99):02d}"
 
 
@@ -249,18 +531,18 @@ def page_health():
     st.title("WishCo Branch Portal — เบิกอุปกรณ์")
     st.header("🩺 Health Check")
     keys = []
-    try:
-        s = st.secrets
-        for k in ("GOOGLE_SERVICE_ACCOUNT_JSON","gcp_service_account",
-                  "SHEET_ID","SPREADSHEET_ID","SHEET_URL","SPREADSHEET_URL"):
-            if k in s: keys.append(k)
-    except Exception: pass
+    s = _secrets()
+    for k in ("GOOGLE_SERVICE_ACCOUNT_JSON","gcp_service_account",
+              "SHEET_ID","SPREADSHEET_ID","SHEET_URL","SPREADSHEET_URL"):
+        if k in s: keys.append(k)
     for k in ("SHEET_ID","SPREADSHEET_ID","SHEET_URL","SPREADSHEET_URL"):
         if os.environ.get(k): keys.append(k+" (env)")
     if keys: st.info("พบคีย์เชื่อมต่อ: " + ", ".join(keys))
     try:
         ss = _open_spreadsheet()
-        st.success(f"เชื่อมต่อสเปรดชีตได้: {ss.title}")
+        # live metadata call: the cached handle's .title never touches the network
+        meta = ss.fetch_sheet_metadata({"fields": "properties.title"})
+        st.success(f"เชื่อมต่อสเปรดชีตได้: {meta['properties']['title']}")
     except Exception as e:
         st.error(f"เชื่อมต่อไม่ได้: {e}")
 
@@ -272,17 +554,15 @@ def page_login():
     if st.sidebar.button("ล็อกอิน", use_container_width=True):
         try:
             ss = _open_spreadsheet()
-            df = _read_users_df(ss)
+            users = _users_index(ss, ss.id, _ver("Users"))
         except Exception as e:
             st.error(f"เชื่อมต่อ/อ่าน Users ไม่สำเร็จ: {e}"); return
-        df["un_norm"] = df["username"].astype(str).str.strip().str.lower()
-        row = df[df["un_norm"] == (u or "").strip().lower()].head(1)
-        if row.empty: st.error("ไม่พบบัญชีผู้ใช้"); return
-        r = row.iloc[0]
-        if "active" in df.columns and not _is_active(r.get("active")):
-            st.error("บัญชีนี้ถูกปิดการใช้งาน"); return
-        if not _verify_pw(r, p):
-            st.error("รหัสผ่านไม่ถูกต้อง"); return
+        r = users.get((u or "").strip().lower())
+        # one verify and one message for unknown, disabled and wrong-password alike,
+        # so neither the text nor the timing tells which usernames exist
+        ok = _verify_pw(r if r is not None else _stand_in_user(users), p)
+        if r is None or not ok or ("active" in r and not _is_active(r.get("active"))):
+            st.error("ชื่อผู้ใช้หรือรหัสผ่านไม่ถูกต้อง"); return
         st.session_state["user"] = {
             "username": str(r.get("username") or ""),
             "displayname": str(r.get("displayname") or ""),
@@ -295,26 +575,23 @@ def page_login():
 
 
 def _items_editor(ss):
-    items = _read_items_df(ss)
-    if "active" in items.columns:
-        items = items[items["active"].apply(_is_active)]
+    items = _active_items(ss, ss.id, _ver("Items"))
     q = st.text_input("ค้นหาชื่อ/รหัสอุปกรณ์", placeholder="พิมพ์คำค้น เช่น 'สาย HDMI' หรือ 'HDMI'")
     if q:
         s = q.strip().lower()
-        items = items[ items["itemname"].astype(str).str.lower().str.contains(s) | 
-                       items["itemcode"].astype(str).str.lower().str.contains(s) ]
+        items = items[items["_search"].str.contains(s, regex=False)]
 
-    codes = items["itemcode"].astype(str).tolist()
+    codes = items["itemcode"].tolist()
     sel = [bool(st.session_state["sel_map"].get(c, False)) for c in codes]
     qty = [int(st.session_state["qty_map"].get(c, 0)) for c in codes]
 
     table = pd.DataFrame({
         "เลือก": sel,
         "รหัส": codes,
-        "รายการ": items["itemname"].astype(str).tolist(),
+        "รายการ": items["itemname"].tolist(),
         "จำนวนที่เบิก": qty,
-        "หน่วย": items.get("unit", pd.Series([""]*len(codes))).astype(str).tolist(),
-    })
+        "หน่วย": items["unit"].tolist() if "unit" in items.columns else [""]*len(codes),
+    }).astype({"เลือก": bool, "จำนวนที่เบิก": int})  # keep editor dtypes when the search matches nothing
 
     edited = st.data_editor(
         table,
@@ -336,19 +613,24 @@ def _items_editor(ss):
         st.session_state["qty_map"].clear()
         _safe_rerun()
 
+    # session keeps only selected codes / non-zero qty; write back just the rows that changed
+    sel_map, qty_map = st.session_state["sel_map"], st.session_state["qty_map"]
+    code = edited["รหัส"]
+    was_sel = code.map(sel_map).fillna(False).astype(bool)
+    old_qty = code.map(qty_map).fillna(0).astype(int)
+    sel_now = edited["เลือก"].fillna(False).astype(bool)
+    qty_now = edited["จำนวนที่เบิก"].fillna(0).astype(int)
     # auto qty=1 when checked first time
-    changed = False
-    for i, r in edited.iterrows():
-        code = r["รหัส"]
-        selected = bool(r["เลือก"])
-        qty_val = int(r["จำนวนที่เบิก"] or 0)
-        if selected and not st.session_state["sel_map"].get(code, False) and qty_val <= 0:
-            edited.at[i, "จำนวนที่เบิก"] = 1
-            qty_val = 1
-            changed = True
-        st.session_state["sel_map"][code] = selected
-        st.session_state["qty_map"][code] = qty_val
-    if changed: _safe_rerun()
+    first = sel_now & ~was_sel & (qty_now <= 0)
+    qty_now = qty_now.mask(first, 1)
+    edited.loc[first, "จำนวนที่เบิก"] = 1
+    diff = (sel_now != was_sel) | (qty_now != old_qty)
+    for c, selected, q in zip(code[diff], sel_now[diff], qty_now[diff]):
+        if selected: sel_map[c] = True
+        else: sel_map.pop(c, None)
+        if q > 0: qty_map[c] = int(q)
+        else: qty_map.pop(c, None)
+    if first.any(): _safe_rerun()
 
     return edited, items
 
@@ -361,168 +643,158 @@ def _requests_and_history_tabs(ss, user):
     """
     t1, t2 = st.tabs(["คำขอที่ส่ง (ล่าสุด)", "ประวัติการเบิก"])
 
-    # ---------- Tab 1: Recent Requests ----------
     with t1:
-        st.subheader("คำขอที่ส่ง (ล่าสุด)")
-        num = st.slider("จำนวนออเดอร์ล่าสุดที่ต้องการดู", 1, 50, 5, 1, key="slider_recent_reqs")
-
-        try:
-            ws = _requests_ws(ss)
-            vals = ws.get_all_values()
-            if not vals or len(vals) <= 1:
-                st.dataframe(pd.DataFrame(columns=["ไอคอน","เลขที่ออเดอร์","รายการ","จำนวนรวม","สถานะ","เวลา"]),
-                             use_container_width=True, hide_index=True)
-            else:
-                df = pd.DataFrame(vals[1:], columns=vals[0])
-                df = _normalize(df)
-
-                def pick(df, *cands):
-                    for c in cands:
-                        if c in df.columns: return c
-                    lowers = {c.lower(): c for c in df.columns}
-                    for c in cands:
-                        if c.lower() in lowers: return lowers[c.lower()]
-                    return None
-
-                c_user = pick(df, "username","Username")
-                c_id   = pick(df, "requestid","RequestID","orderid")
-                c_qty  = pick(df, "qty","Qty","จำนวน")
-                c_name = pick(df, "itemname","ItemName","รายการ")
-                c_stat = pick(df, "status","Status","สถานะ")
-                c_time = pick(df, "requesttime","RequestTime","time","datetime")
-
-                me = str(user.get("username","")).strip().lower()
-                if c_user:
-                    df = df[df[c_user].astype(str).str.strip().str.lower() == me]
-
-                if c_qty: df["qty_num"] = pd.to_numeric(df[c_qty], errors="coerce").fillna(0).astype(float)
-                else:     df["qty_num"] = 0.0
-                if not c_name: c_name = c_id
-
-                if not c_stat:
-                    df["__status__"] = "Pending"; c_stat="__status__"
-                if not c_time:
-                    df["__time__"] = ""; c_time="__time__"
-
-                if not c_id or df.empty:
-                    st.dataframe(pd.DataFrame(columns=["ไอคอน","เลขที่ออเดอร์","รายการ","จำนวนรวม","สถานะ","เวลา"]),
-                                 use_container_width=True, hide_index=True)
-                else:
-                    df["pair"] = df[c_name].astype(str) + " (" + df["qty_num"].astype(int).astype(str) + ")"
-                    def agg_status(g):
-                        sset = set(str(x).strip().lower() for x in g[c_stat].astype(str))
-                        if "canceled" in sset or "cancelled" in sset: return "Canceled"
-                        if "approved" in sset or "อนุมัติ" in sset: return "Approved"
-                        return "Pending"
-
-                    grp = (df.groupby([c_id], as_index=False)
-                            .agg(รายการ=("pair", lambda s: ", ".join(list(s))),
-                                 จำนวนรวม=("qty_num","sum"),
-                                 เวลา=(c_time,"max"),
-                                 สถานะ=(c_stat, agg_status))
-                          ).sort_values("เวลา", ascending=False).head(num)
-
-                    def icon(s):
-                        ss = str(s).strip().lower()
-                        return "🟡" if ss=="pending" else ("🟢" if ss=="approved" else "🔴")
-                    grp["ไอคอน"] = grp["สถานะ"].map(icon)
-
-                    show = grp.rename(columns={c_id:"เลขที่ออเดอร์"})[["ไอคอน","เลขที่ออเดอร์","รายการ","จำนวนรวม","สถานะ","เวลา"]].copy()
-                    show["จำนวนรวม"] = show["จำนวนรวม"].astype(int)
-                                        # merge with snapshot to ensure immediate visibility of just-submitted order
-                    snap = st.session_state.get("recent_request_snap")
-                    if snap is not None:
-                        try:
-                            if snap["เลขที่ออเดอร์"] not in show["เลขที่ออเดอร์"].astype(str).tolist():
-                                show = pd.concat([pd.DataFrame([snap]), show], ignore_index=True)
-                        except Exception:
-                            pass
-                    st.dataframe(show, use_container_width=True, hide_index=True)
-
-                    pending_ids = show[show["สถานะ"]=="Pending"]["เลขที่ออเดอร์"].tolist()
-                    if pending_ids:
-                        sel = st.selectbox("เลือกเลขที่ออเดอร์ (Pending) เพื่อยกเลิก", pending_ids, key="cancel_reqid_v12")
-                        if st.button("ยกเลิกออเดอร์นี้", type="secondary", key="btn_cancel_req_v12"):
-                            header = vals[0]
-                            lowers = {str(h).strip().lower(): i for i,h in enumerate(header)}
-                            idx_id    = lowers.get("requestid", lowers.get("orderid"))
-                            idx_user  = lowers.get("username")
-                            idx_stat  = lowers.get("status")
-                            idx_note  = lowers.get("note")
-                            changes = []
-                            now = time.strftime("%Y-%m-%d %H:%M:%S")
-                            for rnum in range(2, len(vals)+1):
-                                row = vals[rnum-1]
-                                rid = row[idx_id]   if idx_id  is not None and idx_id  < len(row) else ""
-                                un  = row[idx_user] if idx_user is not None and idx_user < len(row) else ""
-                                stv = row[idx_stat] if idx_stat is not None and idx_stat < len(row) else ""
-                                if str(rid)==str(sel) and str(un).strip().lower()==me and str(stv).strip().lower()=="pending":
-                                    if idx_stat is not None:
-                                        changes.append({"range": f"{chr(ord('A')+idx_stat)}{rnum}", "values": [["Canceled"]]})
-                                    if idx_note is not None:
-                                        changes.append({"range": f"{chr(ord('A')+idx_note)}{rnum}", "values": [[f"Canceled by user at {now}"]]})
-                            if changes:
-                                ws.batch_update(changes)
-                                st.success(f"ยกเลิกออเดอร์ {sel} สำเร็จ")
-                                _safe_rerun()
-                            else:
-                                st.info("ออเดอร์นี้ไม่อยู่ในสถานะ Pending แล้ว")
-                    else:
-                        st.caption("ไม่มีออเดอร์สถานะ Pending")
-
-        except Exception:
-            st.dataframe(pd.DataFrame(columns=["ไอคอน","เลขที่ออเดอร์","รายการ","จำนวนรวม","สถานะ","เวลา"]),
-                         use_container_width=True, hide_index=True)
-
-    # ---------- Tab 2: History (Transactions) ----------
+        _recent_requests_tab(ss, user)
     with t2:
-        st.subheader("ประวัติการเบิก")
-        num2 = st.slider("จำนวนรายการล่าสุดที่ต้องการดู", 1, 200, 50, 1, key="slider_history_tx")
-        try:
-            ws = _transactions_ws(ss)
-            vals = ws.get_all_values()
-            if not vals or len(vals) <= 1:
-                st.dataframe(pd.DataFrame(columns=["เวลา","เลขที่TX","รหัส","รายการ","จำนวน","ประเภท","หมายเหตุ"]),
-                             use_container_width=True, hide_index=True)
-            else:
-                df = pd.DataFrame(vals[1:], columns=vals[0])
-                df = _normalize(df)
-                me = str(user.get("username","")).strip().lower()
-                if "username" in df.columns:
-                    df = df[df["username"].astype(str).str.strip().str.lower() == me]
-                # coerce qty
-                if "qty" in df.columns:
-                    df["qty_num"] = pd.to_numeric(df["qty"], errors="coerce").fillna(0).astype(float)
-                else:
-                    df["qty_num"] = 0.0
-                # select view
-                cols = {}
-                cols["เวลา"]   = df.get("txtime", df.get("time", df.get("requesttime", "")))
-                cols["เลขที่TX"] = df.get("txid", df.get("requestid",""))
-                cols["รหัส"]   = df.get("itemcode","")
-                cols["รายการ"] = df.get("itemname","")
-                cols["จำนวน"]  = df["qty_num"].astype(int)
-                cols["ประเภท"] = df.get("type","")
-                cols["หมายเหตุ"] = df.get("note","")
-                out = pd.DataFrame(cols)
-                # join status from Requests (aggregate per RequestID)
+        _history_tab(ss, user)
+
+
+_RECENT_COLS = ["ไอคอน","เลขที่ออเดอร์","รายการ","จำนวนรวม","สถานะ","เวลา"]
+
+@st.cache_data(ttl=30, show_spinner=False)
+def _my_orders(_ss, sheet_id: str, ver: int, me: str) -> pd.DataFrame:
+    """One user's orders (newest first), aggregated once per Requests version; the slider just takes head()."""
+    df = _typed_df(_ss, sheet_id, "Requests", ver)
+    if df.empty:
+        return pd.DataFrame(columns=_RECENT_COLS)
+    cols = tuple(df.columns)
+    c_id   = _pick_col(cols, ("requestid","RequestID","orderid"))
+    c_name = _pick_col(cols, ("itemname","ItemName","รายการ"))
+    c_stat = _pick_col(cols, ("status","Status","สถานะ"))
+    c_time = _pick_col(cols, ("requesttime","RequestTime","time","datetime"))
+
+    if "_user" in df.columns:
+        df = df[df["_user"] == me]
+
+    if not c_name: c_name = c_id
+    if not c_time: c_time = "__time__"
+    # the filtered frame is a fresh slice: derive columns with assign, no extra copy
+    df = df.assign(qty_num=df["qty_num"] if "qty_num" in df.columns else 0.0,
+                   _rank=_status_ranks(df[c_stat]) if c_stat else 0,
+                   __time__="")
+    if not c_id or df.empty:
+        return pd.DataFrame(columns=_RECENT_COLS)
+
+    if c_name != "itemname" or "_pair" not in df.columns:
+        df = df.assign(_pair=df[c_name].astype(str).str.cat(df["qty_num"].astype(int).astype(str), sep=" (") + ")")
+    # names passed as a dict: keyword names are NFKC-normalized, which alters "ำ"
+    grp = (df.groupby([c_id], as_index=False)
+            .agg(**{"รายการ": ("_pair", ", ".join),
+                    "จำนวนรวม": ("qty_num","sum"),
+                    "เวลา": (c_time,"max"),
+                    "_rank": ("_rank","max")})
+          ).sort_values("เวลา", ascending=False)
+
+    rank = grp["_rank"].to_numpy()
+    grp["สถานะ"] = np.asarray(_STATUS_BY_RANK, dtype=object)[rank]
+    grp["ไอคอน"] = np.asarray(["🟡", "🟢", "🔴"], dtype=object)[rank]
+
+    show = grp[["ไอคอน",c_id,"รายการ","จำนวนรวม","สถานะ","เวลา"]].rename(columns={c_id:"เลขที่ออเดอร์"})
+    show["จำนวนรวม"] = show["จำนวนรวม"].astype(int)
+    return show.reset_index(drop=True)
+
+@_fragment
+def _recent_requests_tab(ss, user):
+    """Requests with icons + cancel pending; the slider reruns only this tab."""
+    st.subheader("คำขอที่ส่ง (ล่าสุด)")
+    num = st.slider("จำนวนออเดอร์ล่าสุดที่ต้องการดู", 1, 50, 5, 1, key="slider_recent_reqs")
+
+    me = str(user.get("username","")).strip().lower()
+    try:
+        show = _my_orders(ss, ss.id, _ver("Requests"), me).head(num)
+        if show.empty:
+            st.dataframe(show, use_container_width=True, hide_index=True)
+        else:
+            # merge with snapshot to ensure immediate visibility of just-submitted order
+            snap = st.session_state.get("recent_request_snap")
+            if snap is not None:
                 try:
-                    ws_req = _requests_ws(ss)
-                    vals_req = ws_req.get_all_values()
-                    if vals_req and len(vals_req)>1:
-                        dfr = pd.DataFrame(vals_req[1:], columns=vals_req[0])
-                        dfr = _normalize(dfr)
-                        if "requestid" in dfr.columns and "status" in dfr.columns:
-                            grp = (dfr.groupby(["requestid"], as_index=False)
-                                     .agg(สถานะ=("status", lambda s: ("Canceled" if any(str(x).strip().lower() in ("canceled","cancelled") for x in s) else ("Approved" if any(str(x).strip().lower()=="approved" for x in s) else "Pending")))) )
-                            out = out.merge(grp.rename(columns={"requestid":"เลขที่TX"}), how="left", on="เลขที่TX")
+                    if snap["เลขที่ออเดอร์"] not in show["เลขที่ออเดอร์"].astype(str).tolist():
+                        show = pd.concat([pd.DataFrame([snap]), show], ignore_index=True)
                 except Exception:
                     pass
-                out = out.tail(num2)
-                st.dataframe(out, use_container_width=True, hide_index=True)
-        except Exception:
+            st.dataframe(show, use_container_width=True, hide_index=True)
+
+            pending_ids = show[show["สถานะ"]=="Pending"]["เลขที่ออเดอร์"].tolist()
+            if pending_ids:
+                sel = st.selectbox("เลือกเลขที่ออเดอร์ (Pending) เพื่อยกเลิก", pending_ids, key="cancel_reqid_v12")
+                if st.button("ยกเลิกออเดอร์นี้", type="secondary", key="btn_cancel_req_v12"):
+                    # re-read live rows: the cached view may lag an admin approval
+                    ws = _requests_ws(ss)
+                    cols = _col_index(ss, "Requests")
+                    idx_id    = cols.get("requestid")
+                    idx_user  = cols.get("username")
+                    idx_stat  = cols.get("status")
+                    idx_note  = cols.get("note")
+                    vals = _live_values(ss, "'Requests'")[0]
+                    live = _values_df(vals) if vals else pd.DataFrame()
+                    def col(i):
+                        if i is None or i >= live.shape[1]: return pd.Series("", index=live.index)
+                        return live.iloc[:, i].astype(str)
+                    hit = ((col(idx_id) == str(sel))
+                           & (col(idx_user).str.strip().str.lower() == me)
+                           & (col(idx_stat).str.strip().str.lower() == "pending"))
+                    changes = []
+                    now = _now_str()
+                    for rnum in np.flatnonzero(hit.to_numpy()) + 2:
+                        cells = {}
+                        if idx_stat is not None: cells[idx_stat+1] = "Canceled"
+                        if idx_note is not None: cells[idx_note+1] = f"Canceled by user at {now}"
+                        changes += _row_ranges(int(rnum), cells)
+                    if changes:
+                        ws.batch_update(changes, value_input_option="RAW")
+                        _invalidate("Requests")
+                        st.success(f"ยกเลิกออเดอร์ {sel} สำเร็จ")
+                        _safe_rerun()
+                    else:
+                        st.info("ออเดอร์นี้ไม่อยู่ในสถานะ Pending แล้ว")
+            else:
+                st.caption("ไม่มีออเดอร์สถานะ Pending")
+
+    except Exception:
+        st.dataframe(pd.DataFrame(columns=_RECENT_COLS), use_container_width=True, hide_index=True)
+
+
+@_fragment
+def _history_tab(ss, user):
+    """Transactions (last N) with status joined from Requests; reruns on its own."""
+    st.subheader("ประวัติการเบิก")
+    num2 = st.slider("จำนวนรายการล่าสุดที่ต้องการดู", 1, 200, 50, 1, key="slider_history_tx")
+    try:
+        df = _sheet_df(ss, "Transactions")
+        if df.empty:
             st.dataframe(pd.DataFrame(columns=["เวลา","เลขที่TX","รหัส","รายการ","จำนวน","ประเภท","หมายเหตุ"]),
                          use_container_width=True, hide_index=True)
+        else:
+            me = str(user.get("username","")).strip().lower()
+            if "_user" in df.columns:
+                df = df[df["_user"] == me]
+            # select view
+            cols = {}
+            cols["เวลา"]   = df.get("txtime", df.get("time", df.get("requesttime", "")))
+            cols["เลขที่TX"] = df.get("txid", df.get("requestid",""))
+            cols["รหัส"]   = df.get("itemcode","")
+            cols["รายการ"] = df.get("itemname","")
+            cols["จำนวน"]  = df["qty_num"].astype(int) if "qty_num" in df.columns else 0
+            cols["ประเภท"] = df.get("type","")
+            cols["หมายเหตุ"] = df.get("note","")
+            out = pd.DataFrame(cols)
+            # join status from Requests (aggregate per RequestID)
+            try:
+                dfr = _sheet_df(ss, "Requests")
+                if not dfr.empty:
+                    if "requestid" in dfr.columns and "status" in dfr.columns:
+                        rank = _status_ranks(dfr["status"]).groupby(dfr["requestid"]).max()
+                        grp = pd.DataFrame({"เลขที่TX": rank.index,
+                                            "สถานะ": np.asarray(_STATUS_BY_RANK, dtype=object)[rank.to_numpy()]})
+                        out = out.merge(grp, how="left", on="เลขที่TX")
+            except Exception:
+                pass
+            out = out.tail(num2)
+            st.dataframe(out, use_container_width=True, hide_index=True)
+    except Exception:
+        st.dataframe(pd.DataFrame(columns=["เวลา","เลขที่TX","รหัส","รายการ","จำนวน","ประเภท","หมายเหตุ"]),
+                     use_container_width=True, hide_index=True)
 
 
 def page_issue():
@@ -535,14 +807,26 @@ def page_issue():
     except Exception as e:
         st.error(f"เชื่อมต่อสเปรดชีตไม่ได้: {e}"); return
 
+    # messages from a submit that happened inside the form fragment
+    for kind, msg in st.session_state.pop("issue_flash", []):
+        getattr(st, kind)(msg)
+    _issue_form(ss, user)
+
+    # history table with icons + cancel
+    _requests_and_history_tabs(ss, user)
+
+
+@_fragment
+def _issue_form(ss, user):
+    """Item picker, summary and confirm; editing reruns only this part of the page."""
     edited, items = _items_editor(ss)
 
     # summary + confirm
-    chosen = edited[(edited["เลือก"]==True) & (edited["จำนวนที่เบิก"]>0)].copy()
+    chosen = edited[(edited["เลือก"]==True) & (edited["จำนวนที่เบิก"]>0)]
     if not chosen.empty:
         st.subheader("สรุปรายการที่จะเบิก")
-        sum_df = chosen[["รหัส","รายการ","จำนวนที่เบิก","หน่วย"]].copy()
-        sum_df["จำนวนที่เบิก"] = pd.to_numeric(sum_df["จำนวนที่เบิก"], errors="coerce").fillna(0).astype(int)
+        sum_df = chosen[["รหัส","รายการ","จำนวนที่เบิก","หน่วย"]].assign(
+            **{"จำนวนที่เบิก": pd.to_numeric(chosen["จำนวนที่เบิก"], errors="coerce").fillna(0).astype(int)})
 
         # in-cell spinner editor
         sum_df2 = st.data_editor(
@@ -555,45 +839,55 @@ def page_issue():
             },
             key="summary_editor_v11",
         )
-        for _, r in sum_df2.iterrows():
-            st.session_state["qty_map"][str(r["รหัส"])] = int(r["จำนวนที่เบิก"] or 0)
+        st.session_state["qty_map"].update(
+            (str(c), int(q or 0)) for c, q in zip(sum_df2["รหัส"], sum_df2["จำนวนที่เบิก"]))
 
         if st.button("ยืนยันการเบิก", type="primary", use_container_width=True):
             # validate stock
-            full_items = _read_items_df(ss)
-            insufficient = []
-            pairs = []
-            for code in sum_df2["รหัส"].tolist():
-                q = int(st.session_state["qty_map"].get(code, 0))
-                if q > 0:
-                    pairs.append((code, q))
-                    have = float(full_items[full_items["itemcode"].astype(str)==code].head(1).get("stock", pd.Series([0])).iloc[0] or 0)
-                    if q > have:
-                        name = str(full_items[full_items["itemcode"].astype(str)==code].head(1).get("itemname", pd.Series([""])).iloc[0])
-                        insufficient.append((code, name, have, q))
+            # live stock + RequestID column (not the whole Requests sheet) in one batchGet
+            _ensure_sheet(ss, "Items", ITEMS_HEADER)
+            items_vals, id_vals = _live_values(ss, "'Items'", _col_range(ss, "Requests", "requestid", 1))
+            full_items = _read_items_df(ss, items_vals)
+            # plain column arrays (first row per code) and one indexer call for the
+            # selected codes, instead of a dict-of-dicts over the whole catalog
+            all_codes = full_items["itemcode"].astype(str)
+            first = ~all_codes.duplicated().to_numpy()
+            codes = all_codes.to_numpy()[first]
+            names = full_items.get("itemname", pd.Series("", index=full_items.index)).astype(str).to_numpy()[first]
+            stock = full_items.get("stock", pd.Series(0.0, index=full_items.index)).to_numpy(dtype=float)[first]
+            pairs = [(c, int(st.session_state["qty_map"].get(c, 0))) for c in sum_df2["รหัส"].tolist()]
+            pairs = [(c, q) for c, q in pairs if q > 0]
+            pos = pd.Index(codes).get_indexer([c for c, _ in pairs])
+            found = pos >= 0
+            # index only the hits: with no Items rows left, stock[-1] would raise
+            have_arr = np.zeros(len(pairs))
+            have_arr[found] = stock[pos[found]]
+            name_arr = np.full(len(pairs), "", dtype=object)
+            name_arr[found] = names[pos[found]]
+            insufficient = [(c, name_arr[i], float(have_arr[i]), q)
+                            for i, (c, q) in enumerate(pairs) if q > have_arr[i]]
             if insufficient:
                 msg = "สต็อกไม่พอ: " + ", ".join([f"{c} ({have} < {need})" for c,_,have,need in insufficient])
                 st.error(msg); return
 
-            order_id = _generate_order_id(ss, user.get("username",""))
-            now = time.strftime("%Y-%m-%d %H:%M:%S")
+            # one clock read: the id's YYMMDD always matches the row time
+            t = time.localtime()
+            order_id = _generate_order_id(user.get("username",""), [r[0] for r in id_vals[1:]], t)
+            now = _now_str(t)
 
-            req_rows = []
-            for code, q in pairs:
-                row = full_items[full_items["itemcode"].astype(str)==code].head(1).iloc[0]
-                req_rows.append([ now, order_id, user.get("username",""), user.get("branch_code",""),
-                                  row.get("itemcode"), row.get("itemname"), q, "Pending", "" ])
+            req_rows = [[ now, order_id, user.get("username",""), user.get("branch_code",""),
+                          code, str(name_arr[i]), q, "Pending", "" ] for i, (code, q) in enumerate(pairs)]
             try:
-                _append_rows(_requests_ws(ss), req_rows)
-                # also append to Transactions for history
+                # Requests + Transactions (history) go out in a single round-trip
                 tx_rows = [ [now, order_id, user.get("username",""), user.get("branch_code",""), r[4], r[5], r[6], "Request", ""] for r in req_rows ]
-                try:
-                    _append_rows(_transactions_ws(ss), tx_rows)
-                except Exception:
-                    pass
+                _append_rows_batch(ss, [(_requests_ws(ss), _in_sheet_order(ss, "Requests", req_rows)),
+                                        (_transactions_ws(ss), _in_sheet_order(ss, "Transactions", tx_rows))])
+                _invalidate("Requests", "Transactions")
                 st.session_state["last_order_id"] = order_id
-                st.success(f"ส่งคำขอเบิกเรียบร้อย เลขที่ออเดอร์: {order_id} | รายการ: {len(req_rows)}")
-                st.info("คำขอถูกบันทึกลงชีต 'Requests' เรียบร้อยแล้ว (สถานะ: Pending)")
+                st.session_state["issue_flash"] = [
+                    ("success", f"ส่งคำขอเบิกเรียบร้อย เลขที่ออเดอร์: {order_id} | รายการ: {len(req_rows)}"),
+                    ("info", "คำขอถูกบันทึกลงชีต 'Requests' เรียบร้อยแล้ว (สถานะ: Pending)"),
+                ]
                 # build snapshot for immediate display in Recent tab
                 try:
                     snap_series = {
@@ -610,12 +904,11 @@ def page_issue():
                 st.session_state["sel_map"].clear(); st.session_state["qty_map"].clear()
             except Exception as e:
                 st.error(f"บันทึกคำขอไม่สำเร็จ: {e}")
+                return
+            _safe_rerun()  # whole page, so the tabs pick up the new order
     else:
         st.info("ยังไม่เลือกรายการ")
 
-    # history table with icons + cancel
-    _requests_and_history_tabs(ss, user)
-
 
 def main():
     st.set_page_config(page_title="WishCo Branch Portal", layout="wide", page_icon="🧰")